@@ -1,9 +1,19 @@
-from PIL import Image
-from pillow_heif import register_heif_opener
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
+import queue
+import sys
+import threading
 
 
-register_heif_opener()
+_registered = False
+
+def register_heic():
+    """Registers the HEIF opener with Pillow once per process."""
+    global _registered
+    if not _registered:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        _registered = True
 
 def convert_heic_to_jpg(heic_filepath, jpg_filepath):
     """Converts an HEIC image to JPG format.
@@ -12,27 +22,140 @@ def convert_heic_to_jpg(heic_filepath, jpg_filepath):
         heic_filepath: Path to the input HEIC file.
         jpg_filepath: Path to save the output JPG file.
     """
+    from PIL import Image
+
+    register_heic()
     try:
         img = Image.open(heic_filepath)
-        cimg = img.convert('RGB')
-        cimg = cimg.resize((cimg.width // 4, cimg.height // 4))
-        cimg.save(jpg_filepath, "jpeg")
+        # box-average 4x4 blocks before converting so the full-resolution
+        # RGB copy is never made
+        cimg = img.reduce(4).convert('RGB')
+        cimg.save(jpg_filepath, "jpeg", quality=85, optimize=False,
+                  progressive=False)
         print(f"Converted {heic_filepath} to {jpg_filepath}")
     except Exception as e:
          print(f"Error converting {heic_filepath}: {e}")
 
-def convert_directory_heic_to_jpg(src_path, dest_path):
+def convert_heic_batch(jobs, depth=1):
+    """Converts a batch of HEIC images to JPG format.
+
+    Decoding, downscaling and encoding run in separate threads connected by
+    bounded queues, so the JPEG encode of one file overlaps the HEIC decode
+    of the next.
+
+    Args:
+        jobs: List of (heic_filepath, jpg_filepath) pairs to convert.
+        depth: Maximum number of full-resolution images waiting to be
+            downscaled (kept small since every worker process holds its own).
+    """
+    from PIL import Image
+
+    register_heic()
+    decoded = queue.Queue(maxsize=depth)
+    resized = queue.Queue(maxsize=4)
+    stop = threading.Event()
+
+    # stages wait with a timeout so they notice a cancelled batch instead of
+    # blocking forever on a queue the consumer has stopped serving
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def decode():
+        for heic_filepath, jpg_filepath in jobs:
+            if stop.is_set():
+                return
+            try:
+                img = Image.open(heic_filepath)
+                img.load()
+            except Exception as e:
+                print(f"Error converting {heic_filepath}: {e}")
+                continue
+            if not put(decoded, (heic_filepath, jpg_filepath, img)):
+                return
+        put(decoded, None)
+
+    def resize():
+        while (item := get(decoded)) is not None:
+            heic_filepath, jpg_filepath, img = item
+            try:
+                # box-average 4x4 blocks before converting so the
+                # full-resolution RGB copy is never made
+                cimg = img.reduce(4).convert('RGB')
+            except Exception as e:
+                print(f"Error converting {heic_filepath}: {e}")
+                continue
+            if not put(resized, (heic_filepath, jpg_filepath, cimg)):
+                return
+        put(resized, None)
+
+    stages = [threading.Thread(target=decode, daemon=True),
+              threading.Thread(target=resize, daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    try:
+        # encode and write in the calling thread
+        while (item := resized.get()) is not None:
+            heic_filepath, jpg_filepath, cimg = item
+            try:
+                cimg.save(jpg_filepath, "jpeg", quality=85, optimize=False,
+                          progressive=False)
+                print(f"Converted {heic_filepath} to {jpg_filepath}")
+            except Exception as e:
+                print(f"Error converting {heic_filepath}: {e}")
+    finally:
+        # if the consumer exits early (e.g. Ctrl-C), tell the stages to stop
+        stop.set()
+        for stage in stages:
+            stage.join()
+
+def convert_directory_heic_to_jpg(src_path, dest_path, max_workers=None):
     """Converts all HEIC images in a directory to JPG format.
 
+    The files are split into one batch per worker process, so the conversion
+    scales with the number of available cores, and each batch is converted
+    with a decode/downscale/encode pipeline.
+
     Args:
-        dir_path: Path to the directory containing HEIC files.
+        src_path: Path to the directory containing HEIC files.
+        dest_path: Path to the directory to save the JPG files in.
+        max_workers: Number of worker processes (defaults to the CPU count).
     """
-    for filename in os.listdir(src_path):
-        if filename.lower().endswith(('.heic', '.heif')):
-            heic_filepath = os.path.join(src_path, filename)
-            jpg_filepath = os.path.join(dest_path, filename[:-5] + '.jpg')
-            convert_heic_to_jpg(heic_filepath, jpg_filepath)
-
-src_path = "D:/capstone/datasets/hayden_butte1/raw"
-dest_path = "D:/capstone/datasets/hayden_butte1/low_res"
-convert_directory_heic_to_jpg(src_path, dest_path)
+    jobs = []
+    with os.scandir(src_path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(('.heic',
+                                                                 '.heif')):
+                jpg_filepath = os.path.join(dest_path,
+                                            entry.name[:-5] + '.jpg')
+                jobs.append((entry.path, jpg_filepath))
+
+    workers = max_workers or os.cpu_count() or 1
+    if sys.platform == 'win32':
+        # ProcessPoolExecutor rejects more than 61 workers on Windows
+        workers = min(workers, 61)
+    batches = [jobs[i::workers] for i in range(workers) if jobs[i::workers]]
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=register_heic) as ex:
+        futures = [ex.submit(convert_heic_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            future.result()
+
+if __name__ == "__main__":
+    src_path = "D:/capstone/datasets/hayden_butte1/raw"
+    dest_path = "D:/capstone/datasets/hayden_butte1/low_res"
+    convert_directory_heic_to_jpg(src_path, dest_path)
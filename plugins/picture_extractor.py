@@ -1,11 +1,15 @@
-import glob
+import fnmatch
+import re
+import shelve
 import shutil
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import click
-import cv2
 import os
-import filetype
-from scipy import signal
-import numpy as np
+
+from . import convert_heic
 
 @click.group(name="PES", help="Picture Extractor Subsystem Control")
 def pic():
@@ -77,6 +81,49 @@ def config_default_locations(working=None, source=None, dest=None):
                        f"directory to: {dest}")
     return
 
+def guess_kind(path):
+    """Guess the type of a file (callers must pass a regular file)"""
+    import filetype
+
+    # let filetype read as many header bytes as its matchers need
+    return filetype.guess(path)
+
+@contextmanager
+def mime_cache():
+    """Open the per-user MIME type cache, or a throwaway dict if it is busy"""
+    cache_dir = click.get_app_dir("GeoMap")
+    os.makedirs(cache_dir, exist_ok=True)
+    lock = os.path.join(cache_dir, "pes_cache.lock")
+    # a lock left behind by a crashed run goes stale after an hour
+    if (os.path.exists(lock)
+            and time.time() - os.path.getmtime(lock) > 3600):
+        os.remove(lock)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # another setup is using the cache; don't risk corrupting it
+        yield {}
+        return
+    try:
+        with shelve.open(os.path.join(cache_dir, "pes_cache")) as db:
+            yield db
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+def cached_mime(entry, db):
+    """Get the MIME type of a directory entry, using the cache if unchanged"""
+    # key on path and store size and mtime so a modified file replaces its
+    # old entry rather than adding a new one
+    st = entry.stat()
+    stamp = (st.st_size, st.st_mtime_ns)
+    cached = db.get(entry.path)
+    if cached is None or cached[0] != stamp:
+        kind = guess_kind(entry.path)
+        cached = (stamp, kind.mime if kind else None)
+        db[entry.path] = cached
+    return cached[1]
+
 @pic.command(name="setup")
 @click.option('--move/--copy', '-m/-c', default=False,
               help="Move the files rather than copying (copies by default).")
@@ -103,18 +150,24 @@ def setup(move=False):
                                "'config' command to set the working directory "
                                "before running 'setup'.")
 
-    # get current directory so we can return after moving files
-    curdir = os.getcwd()
-
-    # open the source directory so path parsing works correctly
-    os.chdir(source)
-
     # find the files in the source directory
-    source_files = os.listdir(source)
-    istype = lambda f, t: ((k := filetype.guess(os.path.join(source, f)))
-                           and k.mime.startswith(t))
-    images = [f for f in source_files if istype(f, 'image')]
-    videos = [f for f in source_files if istype(f, 'video')]
+    with os.scandir(source) as it:
+        source_files = [e for e in it if e.is_file()]
+    # guess each file type once (or reuse the guess from a previous run),
+    # keeping the cache per user so it outlives the working directory
+    with mime_cache() as db:
+        kinds = {e.name: cached_mime(e, db) for e in source_files}
+        # forget files that have since been removed from the source
+        seen = {e.path for e in source_files}
+        for path in [p for p in db.keys()
+                     if os.path.dirname(p) == source and p not in seen]:
+            del db[path]
+    istype = lambda f, t: ((m := kinds[f] if f in kinds else
+                            getattr(guess_kind(os.path.join(source, f)),
+                                    'mime', None))
+                           and m.startswith(t))
+    images = [f for f, m in kinds.items() if m and m.startswith('image')]
+    videos = [f for f, m in kinds.items() if m and m.startswith('video')]
 
     click.echo(
         f"Found {len(images)} images and {len(videos)} videos in the source "
@@ -127,9 +180,13 @@ def setup(move=False):
             ("Enter a path expression (using '*.jpg', etc.) for your image "
              "set (use '*' to select all images)"),
             type=click.Path())
-        sel_images = glob.glob(img_expr, root_dir=source)
-        # ensure all files are images
-        sel_images = [img for img in sel_images if istype(img, 'image')]
+        # match against the already listed images rather than globbing,
+        # skipping hidden files unless asked for explicitly (as glob does)
+        pattern = re.compile(fnmatch.translate(os.path.normcase(img_expr)))
+        hidden = img_expr.startswith('.')
+        sel_images = [img for img in images
+                      if (hidden or not img.startswith('.'))
+                      and pattern.match(os.path.normcase(img))]
     else:
         sel_images = []
     click.echo(f"Selected {len(sel_images)} images.\n")
@@ -145,18 +202,18 @@ def setup(move=False):
     while i < ext_vid:
         vid = click.prompt(
             "Enter a video to extract from the source directory",
-            type=click.Path(dir_okay=False, exists=True))
-        # ensure file is a valid video
-        if istype(vid, 'video'):
+            type=click.Path(dir_okay=False))
+        # ensure file exists in the source directory and is a valid video
+        if not os.path.isfile(os.path.join(source, vid)):
+            click.echo(f"The file you entered ({vid}) does not exist in the "
+                       f"source directory!")
+        elif istype(vid, 'video'):
             sel_videos.append(vid)
             i += 1
         else:
             click.echo(f"The file you entered ({vid}) is not a video!")
     click.echo(f"Selected {len(sel_videos)} videos.\n")
 
-    # navigate into the working directory to prevent broken paths
-    os.chdir(working)
-
     # set up the workspace
     if sel_images:
         os.makedirs(f"{working}/input/images", exist_ok=True)
@@ -169,46 +226,116 @@ def setup(move=False):
     # move or copy files based on called options
     ufunc = shutil.move if move else shutil.copy
 
-    # move or copy the images
-    for img in sel_images:
-        ufunc(os.path.join(source, img),
-              os.path.join(working, "input/images", img))
+    # move or copy the images, overlapping the per-file syscalls
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(lambda img: ufunc(os.path.join(source, img),
+                                      os.path.join(working, "input/images",
+                                                   img)),
+                    sel_images))
     click.echo(f"{'Moved' if move else 'Copied'} {len(sel_images)} images to "
                f"working directory.\n")
 
     # move or copy the videos
-    for i, vid in enumerate(sel_videos):
-        ufunc(os.path.join(source, vid),
-              os.path.join(working, f"input/video{i}", vid))
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(lambda iv: ufunc(os.path.join(source, iv[1]),
+                                     os.path.join(working,
+                                                  f"input/video{iv[0]}",
+                                                  iv[1])),
+                    enumerate(sel_videos)))
     click.echo(f"{'Moved' if move else 'Copied'} {len(sel_videos)} videos to "
                f"working directory.\n")
 
-    # return to original directory (where the code was run)
-    os.chdir(curdir)
-
-def extract_video(v, output, n=30):
+def jpeg_encoder():
+    """Create a reusable TurboJPEG encoder, or None if it is unavailable"""
+    try:
+        from turbojpeg import TurboJPEG
+    except ImportError:
+        return None
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError):
+        # the python package is installed but libturbojpeg is missing
+        return None
+
+def write_frame(fname, frame, encoder=None):
+    """Encode a frame to JPEG in memory and write it in a single call"""
+    import cv2
+
+    if encoder is not None:
+        buf = encoder.encode(frame, quality=85)
+    else:
+        ok, buf = cv2.imencode('.jpg', frame,
+                               [cv2.IMWRITE_JPEG_QUALITY, 85,
+                                cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                                cv2.IMWRITE_JPEG_PROGRESSIVE, 0])
+        if not ok:
+            raise IOError(f"Failed to encode frame for {fname}")
+    with open(fname, 'wb', buffering=1 << 20) as f:
+        f.write(buf)
+
+def extract_video(v, output, n=30, workers=4):
     """Extract images from a video"""
     # frame count and index initialization
     frame_index = 0
     frame_count = 0
 
-    # loop through the video and save every nth frame
-    while True:
-        ret, frame = v.read()
-        if not ret:
-            # exit while loop when video ends
-            break
-        # save every nth frame
-        if not frame_count % n:
-            frame_fname = os.path.join(output, f"{frame_index:05}.jpg")
-            cv2.imwrite(frame_fname, frame)
-            frame_index += 1
-        frame_count += 1
-
-    # release video capture object
-    v.release()
+    # encode and write frames in the background while decoding continues
+    pool = ThreadPoolExecutor(max_workers=workers)
+    encoder = jpeg_encoder()
+    writes = deque()
+
+    try:
+        # loop through the video and save every nth frame
+        while True:
+            # grab without converting so skipped frames stay cheap
+            ret = v.grab()
+            if not ret:
+                # exit while loop when video ends
+                break
+            # decode and save every nth frame
+            if not frame_count % n:
+                ret, frame = v.retrieve()
+                if not ret:
+                    break
+                frame_fname = os.path.join(output, f"{frame_index:05}.jpg")
+                # bound the queued frame copies by waiting on the oldest write
+                if len(writes) >= 2 * workers:
+                    writes.popleft().result()
+                # copy the frame since OpenCV may reuse its buffer
+                writes.append(pool.submit(write_frame, frame_fname,
+                                          frame.copy(), encoder))
+                frame_index += 1
+            frame_count += 1
+    finally:
+        # always finish pending writes and release the video capture object,
+        # even if a write failed
+        pool.shutdown(wait=True)
+        v.release()
+
+    # surface any remaining write errors
+    for w in writes:
+        w.result()
     return
 
+def link_or_copy(src, dst):
+    """Hardlink a file, falling back to a copy (e.g. across devices)
+
+    Linked files share an inode with the source, so editing an output image
+    in place also changes the image in input/images.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # already linked by a previous extract, otherwise replace it
+        if os.path.samefile(src, dst):
+            return
+        os.unlink(dst)
+        link_or_copy(src, dst)
+    except OSError:
+        # the filesystem cannot link these files (cross-device, FAT/exFAT
+        # volumes, network shares, ...), so copy instead
+        shutil.copy(src, dst)
+
 @pic.command(name="extract")
 def extract():
     """Set up the picture extractor by moving/copying.
@@ -219,6 +346,8 @@ def extract():
     A flag is available on this command to choose whether to move or copy the
     files from the source to the working directory.
     """
+    import cv2
+
     ctx = click.get_current_context().obj
 
     # check that required parameters are set
@@ -266,8 +395,8 @@ def extract():
         # extract images if video, else copy images
         if choice == 'images':
             for img in os.listdir(f"{working}/input/images"):
-                shutil.copy(f"{working}/input/images/{img}",
-                            f"{working}/output/set{i}/{img}")
+                link_or_copy(f"{working}/input/images/{img}",
+                             f"{working}/output/set{i}/{img}")
         elif choice.startswith('video'):
             vname = os.listdir(f"{working}/input/{choice}")
             if not vname:
@@ -277,23 +406,59 @@ def extract():
             video = cv2.VideoCapture(vpath)
             extract_video(video, f"{working}/output/set{i}")
 
-def remove_motion_blur(image_path, kernel_size=15):
+@pic.command(name="heic")
+@click.option('--source', '-s', required=True,
+              type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help="Directory containing the HEIC images to convert.")
+@click.option('--dest', '-d', required=True,
+              type=click.Path(file_okay=False, resolve_path=True),
+              help="Directory to save the converted JPG images in.")
+def heic(source, dest):
+    """Convert a directory of HEIC images to reduced-size JPGs.
+
+    Each image is downscaled to a quarter of its original width and height.
+    The destination directory is created if it does not already exist.
+    """
+    os.makedirs(dest, exist_ok=True)
+    convert_heic.convert_directory_heic_to_jpg(source, dest)
+
+def remove_motion_blur(image_path, kernel_size=15, show=False, nsr=0.01):
+    """Deblur an image, save it and return the deblurred array"""
+    import cv2
+    import numpy as np
+
     # Load the image
     img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    imf = img.astype(np.float32)
 
     # Create a motion blur kernel (linear blur)
-    kernel = np.zeros((kernel_size, kernel_size))
+    kernel = np.zeros((kernel_size, kernel_size), np.float32)
     kernel[int((kernel_size - 1)/2), :] = np.ones(kernel_size)
     kernel /= kernel_size  # Normalize the kernel
 
-    # Apply Wiener filter for deblurring
-    deblurred = signal.wiener(img, (5, 5))  # Wiener filter (5x5 neighborhood)
+    # Pad the kernel to the image size, centred on the origin
+    psf = np.zeros_like(imf)
+    psf[:kernel_size, :kernel_size] = kernel
+    psf = np.roll(psf, (-(kernel_size // 2), -(kernel_size // 2)), (0, 1))
+
+    # Apply Wiener deconvolution in the frequency domain:
+    # F = G * conj(H) / (|H|^2 + nsr)
+    G = cv2.dft(imf, flags=cv2.DFT_COMPLEX_OUTPUT)
+    H = cv2.dft(psf, flags=cv2.DFT_COMPLEX_OUTPUT)
+    H2 = H[..., 0] ** 2 + H[..., 1] ** 2
+    F = cv2.mulSpectrums(G, H, 0, conjB=True) / (H2 + nsr)[..., None]
+    deblurred = cv2.idft(F, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
 
     # Normalize the result
     deblurred = np.clip(deblurred, 0, 255).astype(np.uint8)
 
-    # Save and show the result
+    # Save the result
     cv2.imwrite("deblurred_image.jpg", deblurred)
-    cv2.imshow("Deblurred Image", deblurred)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+
+    # only open a window when asked, so batch runs never block on it
+    if show:
+        cv2.imshow("Deblurred Image", deblurred)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+    return deblurred